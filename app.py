@@ -1,14 +1,43 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import re
-import json
-import csv 
+import itertools
+import openpyxl
+import orjson
+import csv
+import codecs
+import importlib.util
+
+# Arrow-backed strings when pyarrow is available (streamlit ships it).
+_HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+_STRING_DTYPE = 'string[pyarrow]' if _HAS_PYARROW else 'string'
 
 # ==========================================
 # 1. HELPER FUNCTIONS (Shared by both modes)
 # ==========================================
 
+# Typography fixes (smart quotes, ellipsis, dashes), built once at import.
+_TRANS = str.maketrans({'“': '"', '”': '"', '’': "'", '‘': "'", '…': '...', '–': '-', '—': '-'})
+# Whitespace right after '${' or right before '}'.
+_RPL_SPACE_RE = re.compile(r'\$\{\s|\s\}')
+
+REQUIRED_MAP = {
+    'Priority': ['priority', 'prio'],
+    'Description': ['desc', 'description', 'context'],
+    'Module_Type': ['module', 'module_type', 'modul'],
+    'DB_Field_Name': ['field', 'db_field_name', 'db_field'],
+    'SITE_BRAND': ['site_brand', 'brand', 'brand_name'],
+    'CAMPAIGN_NAME': ['campaign_name', 'campaign', 'camapign_name', 'camp_name'],
+    'SITE_COUNTRY': ['site_country', 'country']
+}
+# Lowercase alias -> standard header, so each column is a single dict hit.
+_HEADER_LOOKUP = {alias: std for std, aliases in REQUIRED_MAP.items() for alias in (*aliases, std.lower())}
+
+# Key columns repeated on every melted row; stored as category after loading.
+CATEGORY_COLS = ['Priority', 'Module_Type', 'DB_Field_Name', 'SITE_BRAND', 'SITE_COUNTRY', 'CAMPAIGN_NAME']
+
 def clean_headers(df):
     """ Normalizes headers, removing spaces, typos, and ghost columns. """
     # FIX 1: Force all headers to string to prevent "float is not iterable" crash
@@ -17,75 +46,151 @@ def clean_headers(df):
     # Drop purely empty/nan ghost columns
     df = df.loc[:, (df.columns != 'nan') & (df.columns != '')]
     
-    required_map = {
-        'Priority': ['priority', 'prio'], 
-        'Description': ['desc', 'description', 'context'],
-        'Module_Type': ['module', 'module_type', 'modul'],
-        'DB_Field_Name': ['field', 'db_field_name', 'db_field'],
-        'SITE_BRAND': ['site_brand', 'brand', 'brand_name'],
-        'CAMPAIGN_NAME': ['campaign_name', 'campaign', 'camapign_name', 'camp_name'],
-        'SITE_COUNTRY': ['site_country', 'country']
-    }
-    
-    new_columns = {}
-    for col in df.columns:
-        col_lower = col.lower()
-        for standard_name, alternatives in required_map.items():
-            if col_lower == standard_name.lower() or col_lower in alternatives:
-                new_columns[col] = standard_name
-                
-    if new_columns:
-        df.rename(columns=new_columns, inplace=True)
-    return df
-
-def validate_and_clean_rpl(text):
-    """ Checks for RPL syntax errors and smart quotes. """
-    if pd.isna(text) or str(text).strip() == "":
-        return "", None
-    text = str(text).strip()
-    
-    if text.upper() == '[EMPTY]':
-        return "[EMPTY]", None
-    
-    replacements = {'“': '"', '”': '"', '’': "'", '‘': "'", '…': '...', '–': '-', '—': '-'}
-    for bad, good in replacements.items():
-        text = text.replace(bad, good)
-        
-    open_tags = text.count('${')
-    close_tags = text.count('}')
-    if open_tags != close_tags:
-        return text, f"CRITICAL: Mismatched braces. Found {open_tags} '${{' but {close_tags} '}}'."
-    if re.search(r'\$\{\s+', text) or re.search(r'\s+\}', text):
-        return text, "WARNING: Spaces detected inside RPL tag."
-        
-    return text, None
+    return df.rename(columns=lambda c: _HEADER_LOOKUP.get(c.lower(), c))
+
+def validate_and_clean_rpl_column(values):
+    """ Checks a whole column for RPL syntax errors and fixes smart quotes.
+    Returns (cleaned, errors): errors holds the message per row, missing where the cell is fine. """
+    s = values.astype(_STRING_DTYPE).fillna("").str.strip()
+    # Match the [EMPTY] marker in place rather than upper-casing a copy of every cell.
+    s = s.mask(s.str.fullmatch(r'\[EMPTY\]', case=False, na=False), '[EMPTY]').str.translate(_TRANS)
+
+    errors = pd.Series(None, index=s.index, dtype=object)
+
+    # Most cells carry no RPL at all; only cells with '${' or '}' need the checks below.
+    tagged = s.str.contains(r'\$\{|\}', regex=True, na=False).to_numpy(dtype=bool)
+    if not tagged.any():
+        return s, errors
+    t = s[tagged]
+
+    open_tags = t.str.count(r'\$\{').to_numpy(dtype=int)
+    close_tags = t.str.count(r'\}').to_numpy(dtype=int)
+    brace_mismatch = open_tags != close_tags
+    # Python re on the few tagged cells: Arrow's regex engine treats \s as ASCII-only
+    # and would miss non-breaking or thin spaces inside a tag.
+    has_space = np.fromiter((_RPL_SPACE_RE.search(text) is not None for text in t.tolist()), dtype=bool, count=len(t))
+    space_warn = has_space & ~brace_mismatch
+
+    brace_msg = (
+        "CRITICAL: Mismatched braces. Found " + open_tags.astype(str).astype(object)
+        + " '${' but " + close_tags.astype(str).astype(object) + " '}'."
+    )
+    space_msg = np.where(space_warn, "WARNING: Spaces detected inside RPL tag.", None)
+    errors[tagged] = np.where(brace_mismatch, brace_msg, space_msg)
+    return s, errors
+
+def melt_languages(df, existing_meta, lang_cols):
+    """ Wide -> long (one row per language cell), same row order as df.melt.
+    The empty-cell filter runs on the wide values, so dropped cells are never materialized. """
+    values = df[lang_cols].to_numpy(dtype=object)
+    if 'DB_Field_Name' in df.columns:
+        structural = (df['DB_Field_Name'].isna() | (df['DB_Field_Name'] == "")).to_numpy()
+    else:
+        structural = np.ones(len(df), dtype=bool)
+
+    # FIX 2: Smart Drop Logic for Structural Modules
+    # Keep cells with text, OR rows that are structural (no DB field defined)
+    keep = (pd.notna(values) & (values != "")) | structural[:, None]
+    lang_idx, row_idx = np.nonzero(keep.T)
+
+    melted = df[existing_meta].take(row_idx).reset_index(drop=True)
+    melted['SITE_LANGUAGE'] = pd.Categorical(np.asarray(lang_cols, dtype=object)[lang_idx])
+    melted['Content'] = pd.Series(values.T[keep.T], dtype=object).astype(_STRING_DTYPE).fillna("")
+    if 'DB_Field_Name' not in melted.columns: melted['DB_Field_Name'] = ""
+    if melted['DB_Field_Name'].isna().any():
+        melted['DB_Field_Name'] = melted['DB_Field_Name'].fillna("")
+    return melted
+
+def find_header_row(rows):
+    """ Returns the index of the first row mentioning Priority or DB_Field_Name (0 if none do). """
+    for idx, row in enumerate(rows):
+        row_str = [str(x).lower() for x in row]
+        if any('priority' in s for s in row_str) or any('db_field_name' in s for s in row_str):
+            return idx
+    return 0
+
+def dedupe_headers(names):
+    """ Names headers the way pandas' own readers do: blank cells become 'Unnamed: <i>'
+    and repeats become 'EN.1', 'EN.2', ..., so a second column with the same name is kept
+    rather than dropped later, and trailing blank headers never look like languages. """
+    blank = [name is None or name == "" for name in names]
+    names = [f"Unnamed: {i}" if is_blank else name for i, (name, is_blank) in enumerate(zip(names, blank))]
+    taken = set(names)
+    seen = set()
+    next_suffix = {}
+    deduped = list(names)
+    # Real headers are settled first, generated 'Unnamed' ones after them.
+    order = [i for i, is_blank in enumerate(blank) if not is_blank] + [i for i, is_blank in enumerate(blank) if is_blank]
+    for i in order:
+        name = names[i]
+        if name in seen:
+            suffix = next_suffix.get(name, 1)
+            while f"{name}.{suffix}" in taken:
+                suffix += 1
+            next_suffix[name] = suffix + 1
+            name = f"{name}.{suffix}"
+            taken.add(name)
+        seen.add(name)
+        deduped[i] = name
+    return deduped
+
+def read_xlsx(uploaded_file):
+    """ Streams the first sheet with openpyxl in read-only mode (no styled cell objects). """
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        # Peek at the top of the sheet to find the header row, then keep streaming.
+        preview = list(itertools.islice(rows, 15))
+        header_row_idx = find_header_row(preview)
+        header = preview[header_row_idx] if preview else ()
+        records = preview[header_row_idx + 1:]
+        records.extend(rows)
+    finally:
+        wb.close()
+
+    # Read-only sheets can report ragged rows; trailing blank rows are noise.
+    while records and all(v is None for v in records[-1]):
+        records.pop()
+    width = max([len(header)] + [len(r) for r in records])
+    columns = dedupe_headers(list(header) + [None] * (width - len(header)))
+    records = [tuple(r) + (None,) * (width - len(r)) for r in records]
+    return pd.DataFrame.from_records(records, columns=columns)
+
+def read_csv(file_bytes):
+    """ Finds the header row and delimiter from a small sample, then parses the file once.
+    Uses the C parser: the pyarrow engine infers types even with dtype=str, so translation
+    text like '2024-01-01 10:00' would come back rewritten. """
+    raw_lines = file_bytes[:65536].splitlines(keepends=True)[:15]
+    lines = [line.decode('utf-8-sig', errors='replace') for line in raw_lines]
+    header_row_idx = find_header_row([line] for line in lines)
+    try:
+        sep = csv.Sniffer().sniff(lines[header_row_idx], delimiters=',;\t|').delimiter
+    except (csv.Error, IndexError):
+        sep = ','
+
+    # Start parsing at the header line itself, so metadata rows above it never reach the parser.
+    data = file_bytes[sum(len(line) for line in raw_lines[:header_row_idx]):]
+    return pd.read_csv(io.BytesIO(data), sep=sep)
 
-def load_and_prep_data(uploaded_file):
-    """ Smart loads Excel/CSV and identifies columns. """
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_and_prep_data(file_bytes, filename):
+    """ Smart loads Excel/CSV and identifies columns.
+    Cached on the file contents, so switching tabs or re-clicking doesn't re-parse the upload. """
     try:
+        uploaded_file = io.BytesIO(file_bytes)
+
         # A. Smart Load (Find Header Row)
-        if uploaded_file.name.endswith('.xlsx') or uploaded_file.name.endswith('.xls'):
+        if filename.endswith('.xlsx'):
+            df = read_xlsx(uploaded_file)
+        elif filename.endswith('.xls'):
             xl_file = pd.ExcelFile(uploaded_file)
             preview = xl_file.parse(header=None, nrows=15)
-            header_row_idx = 0
-            for idx, row in preview.iterrows():
-                row_str = [str(x).lower() for x in row.tolist()]
-                if any('priority' in s for s in row_str) or any('db_field_name' in s for s in row_str):
-                    header_row_idx = idx
-                    break
+            header_row_idx = find_header_row(preview.itertuples(index=False))
             df = xl_file.parse(header=header_row_idx)
         else:
             # FIX 3: Smart loading for messy CSVs with metadata at the top
             try:
-                preview = pd.read_csv(uploaded_file, nrows=15, sep=None, engine='python', header=None)
-                header_row_idx = 0
-                for idx, row in preview.iterrows():
-                    row_str = [str(x).lower() for x in row.tolist()]
-                    if any('priority' in s for s in row_str) or any('db_field_name' in s for s in row_str):
-                        header_row_idx = idx
-                        break
-                uploaded_file.seek(0)
-                df = pd.read_csv(uploaded_file, header=header_row_idx, sep=None, engine='python')
+                df = read_csv(file_bytes)
             except:
                 uploaded_file.seek(0)
                 df = pd.read_csv(uploaded_file, sep=None, engine='python')
@@ -120,7 +225,15 @@ def load_and_prep_data(uploaded_file):
                 bad_values = sorted(set(original_priority[bad_mask].astype(str)))
                 return None, None, None, f"Error: Non-numeric Priority value(s) found: {bad_values}"
 
-        # E. Identify Languages
+        # E. Low-cardinality key columns as category, so melt/reshape/groupby
+        # move small integer codes instead of repeated strings.
+        if 'DB_Field_Name' in df.columns:
+            df['DB_Field_Name'] = df['DB_Field_Name'].fillna("")
+        for c in CATEGORY_COLS:
+            if c in df.columns:
+                df[c] = df[c].astype('category')
+
+        # F. Identify Languages
         lang_cols = [c for c in df.columns if c not in existing_meta]
         lang_cols = [c for c in lang_cols if "unnamed" not in str(c).lower()]
         
@@ -138,37 +251,38 @@ def generate_csv_logic(df, existing_meta, lang_cols, default_campaign, use_engli
             if lang != 'EN':
                 df[lang] = df[lang].fillna(df['EN'])
 
-    melted = df.melt(id_vars=existing_meta, value_vars=lang_cols, var_name='SITE_LANGUAGE', value_name='Content')
-    
-    # FIX 2: Smart Drop Logic for Structural Modules
-    melted['Content'] = melted['Content'].fillna("")
-    if 'DB_Field_Name' not in melted.columns: melted['DB_Field_Name'] = ""
-    melted['DB_Field_Name'] = melted['DB_Field_Name'].fillna("")
-    
-    # Keep rows with text, OR rows that are structural (no DB field defined)
-    melted = melted[(melted['Content'] != "") | (melted['DB_Field_Name'] == "")]
+    melted = melt_languages(df, existing_meta, lang_cols)
 
-    errors = []
-    for index, row in melted.iterrows():
-        cleaned, error_msg = validate_and_clean_rpl(row['Content'])
-        melted.at[index, 'Content'] = cleaned
-        if error_msg:
-            errors.append({'Lang': row['SITE_LANGUAGE'], 'Field': row['DB_Field_Name'], 'Error': error_msg, 'Content': row['Content']})
-    
-    if errors:
-        return None, pd.DataFrame(errors)
+    cleaned, rpl_errors = validate_and_clean_rpl_column(melted['Content'])
+    bad = rpl_errors.notna()
+    if bad.any():
+        error_df = (
+            melted.loc[bad, ['SITE_LANGUAGE', 'DB_Field_Name', 'Content']]
+            .rename(columns={'SITE_LANGUAGE': 'Lang', 'DB_Field_Name': 'Field'})
+            .assign(Error=rpl_errors[bad])
+        )
+        return None, error_df[['Lang', 'Field', 'Error', 'Content']].reset_index(drop=True)
+    melted['Content'] = cleaned
 
     pivot_index = ['SITE_LANGUAGE', 'Priority', 'Module_Type']
     if 'SITE_BRAND' in df.columns: pivot_index.append('SITE_BRAND')
     if 'CAMPAIGN_NAME' in df.columns: pivot_index.append('CAMPAIGN_NAME')
     if 'SITE_COUNTRY' in df.columns: pivot_index.append('SITE_COUNTRY')
 
-    final_df = melted.pivot_table(
-        index=pivot_index, 
-        columns='DB_Field_Name', 
-        values='Content', 
-        aggfunc='first'
-    ).reset_index()
+    # Every (row, field) pair is normally unique, so this is a plain reshape.
+    # Only fall back to an aggregation when the sheet repeats a field.
+    pivot_keys = pivot_index + ['DB_Field_Name']
+    melted = melted.dropna(subset=pivot_index)
+    melted['DB_Field_Name'] = melted['DB_Field_Name'].astype('category').cat.remove_unused_categories()
+    if melted.duplicated(subset=pivot_keys).any():
+        content = melted.groupby(pivot_keys, observed=True)['Content'].first()
+    else:
+        content = melted.set_index(pivot_keys)['Content']
+    # Sort explicitly: with categorical keys the plain reshape would otherwise keep
+    # sheet order, while pivot_table (and the groupby fallback) sort the rows.
+    final_df = content.sort_index().unstack('DB_Field_Name')
+    final_df.columns = final_df.columns.astype(object)
+    final_df = final_df.rename_axis(columns=None).reset_index()
 
     # Clean up empty column generated by structural modules
     if "" in final_df.columns:
@@ -181,9 +295,12 @@ def generate_csv_logic(df, existing_meta, lang_cols, default_campaign, use_engli
     final_df = final_df.replace('[EMPTY]', '')
     final_df.fillna("", inplace=True)
     
-    buffer = io.StringIO()
-    final_df.to_csv(buffer, index=False, sep=',', quoting=csv.QUOTE_ALL)
-    csv_bytes = buffer.getvalue().encode('utf-8-sig')
+    # Write bytes straight into the buffer (BOM first, as utf-8-sig would) instead
+    # of building the whole CSV as a str and encoding a second copy.
+    buffer = io.BytesIO()
+    buffer.write(codecs.BOM_UTF8)
+    final_df.to_csv(buffer, index=False, sep=',', quoting=csv.QUOTE_ALL, encoding='utf-8')
+    csv_bytes = buffer.getvalue()
     
     return csv_bytes, None
 
@@ -193,80 +310,49 @@ def generate_csv_logic(df, existing_meta, lang_cols, default_campaign, use_engli
 def generate_json_logic(df, existing_meta, lang_cols, default_campaign):
     errors = []
     for col in lang_cols:
-        for idx, val in df[col].items():
-            cleaned, error_msg = validate_and_clean_rpl(val)
-            df.at[idx, col] = cleaned
-            if error_msg:
-                 errors.append({'Row': idx, 'Lang': col, 'Error': error_msg, 'Content': val})
+        original = df[col]
+        cleaned, rpl_errors = validate_and_clean_rpl_column(original)
+        df[col] = cleaned
+        bad = rpl_errors.notna()
+        if bad.any():
+            errors.append(pd.DataFrame({'Row': original.index[bad], 'Lang': col, 'Error': rpl_errors[bad].to_numpy(), 'Content': original[bad].to_numpy()}))
     if errors:
-        return None, pd.DataFrame(errors)
+        return None, pd.concat(errors, ignore_index=True)
 
-    melted = df.melt(id_vars=existing_meta, value_vars=lang_cols, var_name='SITE_LANGUAGE', value_name='Content')
-    
-    # FIX 2: Smart Drop Logic for Structural Modules
-    melted['Content'] = melted['Content'].fillna("")
-    if 'DB_Field_Name' not in melted.columns: melted['DB_Field_Name'] = ""
-    melted['DB_Field_Name'] = melted['DB_Field_Name'].fillna("")
-    
-    # Keep rows with text, OR rows that are structural (no DB field defined)
-    melted = melted[(melted['Content'] != "") | (melted['DB_Field_Name'] == "")]
+    melted = melt_languages(df, existing_meta, lang_cols)
 
     if 'CAMPAIGN_NAME' not in melted.columns: melted['CAMPAIGN_NAME'] = default_campaign
     if 'SITE_BRAND' not in melted.columns: melted['SITE_BRAND'] = 'ALL'
     
-    grouped_payloads = {} 
-    unique_keys = melted[['CAMPAIGN_NAME', 'Priority', 'Module_Type', 'SITE_LANGUAGE', 'SITE_BRAND']].drop_duplicates()
-    
-    for _, key_row in unique_keys.iterrows():
-        camp = key_row['CAMPAIGN_NAME']
-        prio = key_row['Priority']
-        mod  = key_row['Module_Type']  
-        lang = key_row['SITE_LANGUAGE']
-        brand = key_row['SITE_BRAND']
-        
-        subset = melted[
-            (melted['CAMPAIGN_NAME'] == camp) & 
-            (melted['Priority'] == prio) & 
-            (melted['Module_Type'] == mod) &
-            (melted['SITE_LANGUAGE'] == lang)
-        ]
-        
-        if subset.empty: continue
+    # Field names and payload values are prepared once for the whole frame,
+    # so the per-group loop below only has to collect them.
+    melted['DB_Field_Name'] = melted['DB_Field_Name'].astype(str).str.strip()
+    melted['Content'] = melted['Content'].replace('[EMPTY]', '')
+
+    json_outputs = []
+    payload_slots = {}  # field signature -> index of its payload in json_outputs
+    group_keys = ['CAMPAIGN_NAME', 'Priority', 'Module_Type', 'SITE_LANGUAGE', 'SITE_BRAND']
+
+    for (camp, prio, mod, lang, brand), subset in melted.groupby(group_keys, sort=False, observed=True):
+        # Skip mapping if it's a structural module with no field
+        pairs = [(field, content) for field, content in zip(subset['DB_Field_Name'], subset['Content']) if field]
+        active_fields = ['CAMPAIGN_NAME', 'PRIORITY', 'MODULE', 'SITE_LANGUAGE', 'SITE_BRAND', *(p[0] for p in pairs)]
+        record_values = [str(camp), str(prio), str(mod), str(lang), str(brand), *(p[1] for p in pairs)]
 
-        active_fields = ['CAMPAIGN_NAME', 'PRIORITY', 'MODULE', 'SITE_LANGUAGE', 'SITE_BRAND']
-        record_values = [str(camp), str(prio), str(mod), str(lang), str(brand)]
-        
-        for _, row in subset.iterrows():
-            field = str(row['DB_Field_Name']).strip()
-            content = row['Content']
-            
-            # Skip mapping if it's a structural module with no field
-            if field == "":
-                continue
-                
-            if content == '[EMPTY]':
-                content = ""
-                
-            active_fields.append(field)
-            record_values.append(str(content))
-            
         shape_signature = tuple(active_fields)
-        if shape_signature not in grouped_payloads:
-            grouped_payloads[shape_signature] = []
-        grouped_payloads[shape_signature].append(record_values)
+        slot = payload_slots.get(shape_signature)
+        if slot is None:
+            slot = payload_slots[shape_signature] = len(json_outputs)
+            json_outputs.append({
+                "recordData": {
+                    "fieldNames": active_fields,
+                    "records": []
+                },
+                "insertOnNoMatch": True,
+                "updateOnMatch": "REPLACE_ALL"
+            })
+        json_outputs[slot]["recordData"]["records"].append(record_values)
 
-    json_outputs = []
-    for shape, records in grouped_payloads.items():
-        payload = {
-            "recordData": {
-                "fieldNames": list(shape),
-                "records": records
-            },
-            "insertOnNoMatch": True,
-            "updateOnMatch": "REPLACE_ALL"
-        }
-        json_outputs.append(payload)
-        
     return json_outputs, None
 
 # ==========================================
@@ -291,7 +377,7 @@ with tab1:
     if uploaded_file:
         if st.button("Generate CSV", key="btn_csv"):
             with st.spinner("Processing CSV..."):
-                df, meta, langs, err = load_and_prep_data(uploaded_file)
+                df, meta, langs, err = load_and_prep_data(uploaded_file.getvalue(), uploaded_file.name)
                 if err:
                     st.error(err)
                 else:
@@ -311,7 +397,7 @@ with tab2:
     if uploaded_file:
         if st.button("Generate JSONs", key="btn_json"):
             with st.spinner("Calculating payloads..."):
-                df, meta, langs, err = load_and_prep_data(uploaded_file)
+                df, meta, langs, err = load_and_prep_data(uploaded_file.getvalue(), uploaded_file.name)
                 if err:
                     st.error(err)
                 else:
@@ -327,6 +413,6 @@ with tab2:
                             st.markdown("---")
                             st.subheader(f"🚀 Payload {i+1} of {total_payloads}")
                             st.caption(f"**Fields updating:** {fields if fields else 'STRUCTURAL MODULE ONLY (No Content)'}")
-                            st.code(json.dumps(payload, indent=2), language='json')
+                            st.code(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode(), language='json')
     else:
         st.warning("👈 Please upload an Excel or CSV file in the sidebar to get started.")